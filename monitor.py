@@ -4,15 +4,28 @@ monitor.py
 
 Popmart などのページを監視して、売り切れ->入荷 または 新着 を検出して Discord に通知します。
 """
+import asyncio
+import bisect
+import functools
+import hashlib
 import json
 import os
+import re
+import sqlite3
 import time
-from datetime import datetime
-from typing import Dict, Any, List, Optional
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import logging
 
 import requests
-from bs4 import BeautifulSoup
+import soupsieve
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+from urllib3.util.retry import Retry
 
 # Playwright optional import
 try:
@@ -21,9 +34,91 @@ try:
 except Exception:
     HAVE_PLAYWRIGHT = False
 
+# aiohttp optional import (通知の並列送信用)
+try:
+    import aiohttp
+    HAVE_AIOHTTP = True
+except Exception:
+    HAVE_AIOHTTP = False
+
+# lxml optional import (BeautifulSoup のパーサを C 実装にする)
+try:
+    import lxml  # noqa: F401
+    BS4_PARSER = "lxml"
+except Exception:
+    BS4_PARSER = "html.parser"
+
+# brotli optional import (requests/urllib3 が Content-Encoding: br を展開できるかどうか)
+try:
+    import brotli  # noqa: F401
+    HAVE_BROTLI = True
+except Exception:
+    HAVE_BROTLI = False
+
+# lxml.etree + cssselect optional import (巨大ページのストリーミング解析用)
+try:
+    from lxml import etree
+    from cssselect import HTMLTranslator, SelectorError
+    HAVE_LXML_STREAM = True
+except Exception:
+    HAVE_LXML_STREAM = False
+
+# blake3 optional import (HTML の変更検知ハッシュ用)
+try:
+    from blake3 import blake3
+    HAVE_BLAKE3 = True
+except Exception:
+    HAVE_BLAKE3 = False
+
+# orjson optional import (state.json / webhook payload のシリアライズ用)
+try:
+    import orjson
+    HAVE_ORJSON = True
+except Exception:
+    HAVE_ORJSON = False
+
+# pyahocorasick optional import (在庫パターンの一括照合用)
+try:
+    import ahocorasick
+    HAVE_AHOCORASICK = True
+except Exception:
+    HAVE_AHOCORASICK = False
+
 LOG = logging.getLogger("popmart-monitor")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
+USER_AGENT = "Mozilla/5.0 (compatible; PopmartMonitor/1.0; +https://github.com/)"
+
+
+def _build_session(retry: Retry) -> requests.Session:
+    # TLS 接続を使い回すための共有セッション
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+# ページ取得用: GET/HEAD は冪等なので一時的なエラーでも再試行する
+_SESSION = _build_session(Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 502, 503],
+    raise_on_status=False,
+))
+
+# Webhook 用: 再送すると二重投稿になり得るので、未処理が確実な 429 と接続失敗だけ再試行する
+_WEBHOOK_SESSION = _build_session(Retry(
+    total=3,
+    connect=3,
+    read=0,
+    other=0,
+    backoff_factor=0.5,
+    status_forcelist=[429],
+    allowed_methods=frozenset({"POST"}),
+    raise_on_status=False,
+))
+
 
 def load_config(path: str = "config.json") -> Dict[str, Any]:
     if not os.path.exists(path):
@@ -32,18 +127,131 @@ def load_config(path: str = "config.json") -> Dict[str, Any]:
         return json.load(f)
 
 
-def save_state(state: Dict[str, Any], path: str):
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
-
-
 def load_state(path: str) -> Dict[str, Any]:
+    """旧形式の state.json を読む (SQLite への移行用)。"""
     if not os.path.exists(path):
-        return {"items": {}}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        return {"items": {}, "http_cache": {}}
+    if HAVE_ORJSON:
+        with open(path, "rb") as f:
+            state = orjson.loads(f.read())
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    # http_cache: {url: {"etag": ..., "last_modified": ...}} (条件付き GET 用)
+    state.setdefault("http_cache", {})
+    return state
+
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    page_url TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    url TEXT,
+    image TEXT,
+    stock_text TEXT,
+    in_stock INTEGER,
+    last_changed TEXT,
+    PRIMARY KEY (page_url, id)
+);
+CREATE TABLE IF NOT EXISTS http_cache (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    html_hash TEXT,
+    cfg_digest TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# 変更検知に使うアイテムの列 (last_changed は含めない)
+_ITEM_FIELDS = ("name", "url", "image", "stock_text", "in_stock")
+
+
+def open_state_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.executescript(STATE_SCHEMA)
+    return conn
+
+
+def _item_row(page_url: str, item_id: str, v: Dict[str, Any]) -> tuple:
+    in_stock = v.get("in_stock")
+    return (page_url, item_id, v.get("name"), v.get("url"), v.get("image"), v.get("stock_text"),
+            None if in_stock is None else int(in_stock), v.get("last_changed"))
+
+
+def load_items(conn: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
+    """{page_url: {item_id: item}} を返す。"""
+    items_by_url: Dict[str, Dict[str, Any]] = {}
+    rows = conn.execute("SELECT page_url, id, name, url, image, stock_text, in_stock, last_changed FROM items")
+    for page_url, item_id, name, url, image, stock_text, in_stock, last_changed in rows:
+        items_by_url.setdefault(page_url, {})[item_id] = {
+            "name": name,
+            "url": url,
+            "image": image,
+            "stock_text": stock_text,
+            "in_stock": None if in_stock is None else bool(in_stock),
+            "last_changed": last_changed
+        }
+    return items_by_url
+
+
+def save_items(conn: sqlite3.Connection, page_url: str, prev_items: Dict[str, Any], new_items: Dict[str, Any]) -> int:
+    """前回から変わった行だけを書き込み、ページから消えた行を削除する。書き込んだ行数を返す。
+    last_changed は行の内容が最後に変わった時刻 (未変更の行は書き直さない)。"""
+    changed = [
+        _item_row(page_url, item_id, v)
+        for item_id, v in new_items.items()
+        if item_id not in prev_items or any(prev_items[item_id].get(f) != v.get(f) for f in _ITEM_FIELDS)
+    ]
+    removed = [(page_url, item_id) for item_id in prev_items.keys() - new_items.keys()]
+    conn.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)", changed)
+    conn.executemany("DELETE FROM items WHERE page_url = ? AND id = ?", removed)
+    return len(changed) + len(removed)
+
+
+def load_http_cache(conn: sqlite3.Connection) -> Dict[str, Dict[str, str]]:
+    cache = {}
+    rows = conn.execute("SELECT url, etag, last_modified, html_hash, cfg_digest FROM http_cache")
+    for url, etag, last_modified, html_hash, cfg_digest in rows:
+        entry = {"etag": etag, "last_modified": last_modified, "html_hash": html_hash, "cfg_digest": cfg_digest}
+        cache[url] = {k: v for k, v in entry.items() if v is not None}
+    return cache
+
+
+def save_http_cache(conn: sqlite3.Connection, http_cache: Dict[str, Dict[str, str]]):
+    conn.executemany(
+        "INSERT OR REPLACE INTO http_cache (url, etag, last_modified, html_hash, cfg_digest) VALUES (?, ?, ?, ?, ?)",
+        [(url, e.get("etag"), e.get("last_modified"), e.get("html_hash"), e.get("cfg_digest"))
+         for url, e in http_cache.items()],
+    )
+
+
+def set_meta(conn: sqlite3.Connection, key: str, value: str):
+    conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+
+def migrate_json_state(conn: sqlite3.Connection, json_path: str, default_url: str):
+    """旧形式の state.json があれば一度だけ DB に取り込む。"""
+    if not os.path.exists(json_path) or conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone():
+        return
+    state = load_state(json_path)
+    rows = [
+        # 旧形式の last_seen を最後に変わった時刻の近似として引き継ぐ
+        _item_row(page_url, item_id, {**v, "last_changed": v.get("last_seen")})
+        for page_url, items in _items_by_url(state, [default_url]).items()
+        for item_id, v in items.items()
+    ]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        save_http_cache(conn, state.get("http_cache", {}))
+        if state.get("last_checked"):
+            set_meta(conn, "last_checked", state["last_checked"])
+        set_meta(conn, "migrated_from", json_path)
+    LOG.info("Migrated %d items from %s", len(rows), json_path)
 
 
 def send_discord_webhook(webhook_url: str, content: Optional[str] = None, embeds: Optional[List[dict]] = None):
@@ -53,7 +261,10 @@ def send_discord_webhook(webhook_url: str, content: Optional[str] = None, embeds
     if embeds:
         payload["embeds"] = embeds
     headers = {"Content-Type": "application/json"}
-    resp = requests.post(webhook_url, json=payload, headers=headers, timeout=15)
+    if HAVE_ORJSON:
+        resp = _WEBHOOK_SESSION.post(webhook_url, data=orjson.dumps(payload), headers=headers, timeout=(5, 15))
+    else:
+        resp = _WEBHOOK_SESSION.post(webhook_url, json=payload, headers=headers, timeout=(5, 15))
     try:
         resp.raise_for_status()
     except Exception as e:
@@ -62,38 +273,245 @@ def send_discord_webhook(webhook_url: str, content: Optional[str] = None, embeds
     return resp
 
 
-def fetch_with_requests(url: str, headers: Optional[dict] = None) -> str:
-    h = headers or {
-        "User-Agent": "Mozilla/5.0 (compatible; PopmartMonitor/1.0; +https://github.com/)"
-    }
-    r = requests.get(url, headers=h, timeout=30)
-    r.raise_for_status()
-    return r.text
+async def _post(session: "aiohttp.ClientSession", url: str, payload: dict, max_attempts: int = 3) -> int:
+    for _ in range(max_attempts):
+        async with session.post(url, json=payload) as resp:
+            if resp.status == 429:
+                # Discord のレート制限: Retry-After 秒だけ待って再送
+                retry_after = float(resp.headers.get("Retry-After") or 1)
+                LOG.warning("Rate limited by Discord, retrying after %.1fs", retry_after)
+                await asyncio.sleep(retry_after)
+                continue
+            if resp.status >= 400:
+                LOG.error("Failed to send webhook: %s %s", resp.status, await resp.text())
+            resp.raise_for_status()
+            return resp.status
+    raise RuntimeError(f"webhook still rate limited after {max_attempts} attempts")
+
+
+async def _send_all(webhook_url: str, payloads: List[dict], concurrency: int = 5) -> List[Any]:
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=10, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=15, connect=5)
+
+    json_serialize = (lambda o: orjson.dumps(o).decode("utf-8")) if HAVE_ORJSON else json.dumps
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, json_serialize=json_serialize) as session:
+        async def bounded(payload: dict):
+            async with sem:
+                return await _post(session, webhook_url, payload)
+
+        return await asyncio.gather(*(bounded(p) for p in payloads), return_exceptions=True)
+
+
+DISCORD_MAX_EMBEDS = 10
+
+
+def _chunks(seq: List[Any], size: int):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def send_notifications(webhook_url: str, notifications: List[tuple], content: Optional[str] = None) -> int:
+    """notifications ([(item, embed), ...]) を最大10件ずつまとめて送信し、送信できた件数を返す。"""
+    if not notifications:
+        return 0
+    chunks = list(_chunks(notifications, DISCORD_MAX_EMBEDS))
+    payloads = []
+    for i, chunk in enumerate(chunks):
+        payload = {"embeds": [embed for _, embed in chunk]}
+        # メンションは最初のメッセージだけに付ける
+        if content and i == 0:
+            payload["content"] = content
+        payloads.append(payload)
+
+    if HAVE_AIOHTTP:
+        # Discord は届いた順に表示するので、ページ順 (とメンション付きの先頭) を保つため 1 件ずつ送る
+        results = asyncio.run(_send_all(webhook_url, payloads, concurrency=1))
+    else:
+        results = []
+        for payload in payloads:
+            try:
+                results.append(send_discord_webhook(webhook_url, content=payload.get("content"), embeds=payload["embeds"]))
+            except Exception as e:
+                results.append(e)
+            time.sleep(1)
+
+    sent = 0
+    for chunk, result in zip(chunks, results):
+        names = ", ".join(str(it.get("name")) for it, _ in chunk)
+        if isinstance(result, BaseException):
+            LOG.error("Failed to send notification for %s: %s", names, result)
+        else:
+            LOG.info("Sent notification for %s", names)
+            sent += len(chunk)
+    return sent
+
+
+def _decode_body(body: bytes, encoding: Optional[str]) -> str:
+    # Response.text と同じく、charset がなければ推定し、Python が知らない charset なら UTF-8 で読む
+    if encoding is None and chardet is not None:
+        encoding = chardet.detect(body)["encoding"]
+    try:
+        return str(body, encoding or "utf-8", errors="replace")
+    except (LookupError, TypeError):
+        return str(body, errors="replace")
+
+
+def fetch_with_requests(url: str, headers: Optional[dict] = None,
+                        validators: Optional[dict] = None) -> Tuple[Optional[str], dict]:
+    """ページを取得して (html, validators) を返す。
+    validators (前回の ETag / Last-Modified) を渡すと条件付き GET になり、
+    304 Not Modified の場合は html が None になる。"""
+    h = dict(headers or {
+        "User-Agent": USER_AGENT
+    })
+    validators = validators or {}
+    if validators.get("etag"):
+        h["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        h["If-Modified-Since"] = validators["last_modified"]
+    h.setdefault("Accept-Encoding", "gzip, br" if HAVE_BROTLI else "gzip")
+    with _SESSION.get(url, headers=h, timeout=30, stream=True) as r:
+        if r.status_code == 304:
+            return None, validators
+        r.raise_for_status()
+        new_validators = {}
+        if r.headers.get("ETag"):
+            new_validators["etag"] = r.headers["ETag"]
+        if r.headers.get("Last-Modified"):
+            new_validators["last_modified"] = r.headers["Last-Modified"]
+        # 展開済みのチャンクをバッファに溜め、最後に一度だけデコードする
+        buf = bytearray()
+        for chunk in r.iter_content(chunk_size=65536):
+            buf.extend(chunk)
+        return _decode_body(bytes(buf), r.encoding), new_validators
+
+
+def html_digest(html: str) -> str:
+    data = html.encode("utf-8")
+    if HAVE_BLAKE3:
+        return blake3(data).hexdigest()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+_SIMPLE_COMPOUND_RE = re.compile(r"^(?P<tag>[a-zA-Z][\w-]*)?(?:\.(?P<cls>[\w-]+)|#(?P<id>[\w-]+))?$")
+
+
+def _is_single_compound(sel: str) -> bool:
+    """sel (カンマ区切りの各要素) が結合子 (空白・> / + / ~) を含まない単一の複合セレクタか。
+    括弧・角括弧・引用符の中の文字は無視する。"""
+    for piece in _split_selector_list(sel):
+        depth = 0
+        quote = None
+        for ch in piece:
+            if quote:
+                if ch == quote:
+                    quote = None
+            elif ch in "\"'":
+                quote = ch
+            elif ch in "([":
+                depth += 1
+            elif ch in ")]":
+                depth -= 1
+            elif depth == 0 and (ch.isspace() or ch in ">+~"):
+                return False
+    return True
+
+
+def _split_selector_list(sel: str) -> List[str]:
+    pieces = []
+    depth = 0
+    quote = None
+    current = ""
+    for ch in sel:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            pieces.append(current.strip())
+            current = ""
+            continue
+        current += ch
+    pieces.append(current.strip())
+    return pieces
+
+
+def _field_selectors_simple(selectors: Dict[str, Any]) -> bool:
+    """item_selector 以外のセレクタがすべて単一の複合セレクタか。
+    結合子があると商品要素自身や祖先を参照し得るので、部分木だけでは評価できない。"""
+    return all(_is_single_compound(v) for k, v in selectors.items() if v and k != "item_selector")
+
+
+def _strainer_from_selector(sel: str) -> Optional[SoupStrainer]:
+    """item_selector の先頭の単純なセレクタ (tag / tag.class / tag#id) から SoupStrainer を作る。
+    複雑なセレクタ (カンマ区切り・属性・擬似クラス・結合子つきなど) の場合は None。"""
+    if "," in sel:
+        return None
+    parts = sel.split()
+    if not parts:
+        return None
+    # 兄弟結合子 (+ / ~) があると先頭要素の部分木の外を参照するので絞り込めない
+    if any("+" in p or "~" in p for p in parts):
+        return None
+    m = _SIMPLE_COMPOUND_RE.match(parts[0])
+    if not m or not any(m.groups()):
+        return None
+    kwargs = {}
+    if m.group("cls"):
+        # 解析中の class 属性は分割前の文字列なので、単語単位で一致させる
+        kwargs["class_"] = re.compile(r"(?:^|\s)%s(?:\s|$)" % re.escape(m.group("cls")))
+    if m.group("id"):
+        kwargs["id"] = m.group("id")
+    # HTML のタグ名はパーサが小文字化するので合わせる
+    tag = m.group("tag").lower() if m.group("tag") else None
+    return SoupStrainer(tag, **kwargs)
+
+
+def config_digest(cfg: Dict[str, Any]) -> str:
+    """解析結果に影響する設定 (セレクタ・在庫パターン) のハッシュ。
+    これが変わったらページが同じでも解析し直す。"""
+    relevant = {k: cfg.get(k) for k in ("selectors", "sold_out_patterns", "in_stock_patterns", "assume_in_stock_if_no_label")}
+    data = json.dumps(relevant, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 def parse_with_bs4(html: str, cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
-    soup = BeautifulSoup(html, "html.parser")
+    # 商品リストを含む部分木だけを構築する
+    # フィールドのセレクタが祖先を参照し得る場合は文書全体を構築する
+    strainer = None
+    if _field_selectors_simple(cfg["selectors"]):
+        strainer = _strainer_from_selector(cfg["selectors"]["item_selector"])
+    soup = BeautifulSoup(html, BS4_PARSER, parse_only=strainer)
+    s = cfg["selectors"]
+    # セレクタは要素ごとに再パースせず、一度だけコンパイルして使い回す
+    sel = {k: soupsieve.compile(v) for k, v in s.items() if v and k != "item_selector"}
     items = []
-    for el in soup.select(cfg["selectors"]["item_selector"]):
+    for el in soupsieve.select(s["item_selector"], soup):
         name = None
         url = None
         image = None
         stock_text = None
         try:
-            s = cfg["selectors"]
-            if s.get("name_selector"):
-                el_name = el.select_one(s["name_selector"])
+            if "name_selector" in sel:
+                el_name = sel["name_selector"].select_one(el)
                 name = el_name.get_text(strip=True) if el_name else None
-            if s.get("url_selector"):
-                el_url = el.select_one(s["url_selector"])
+            if "url_selector" in sel:
+                el_url = sel["url_selector"].select_one(el)
                 if el_url:
                     url = el_url.get("href") or el_url.get("data-href") or el_url.get("data-url")
-            if s.get("image_selector"):
-                el_img = el.select_one(s["image_selector"])
+            if "image_selector" in sel:
+                el_img = sel["image_selector"].select_one(el)
                 if el_img:
                     image = el_img.get("src") or el_img.get("data-src")
-            if s.get("stock_selector"):
-                el_stock = el.select_one(s["stock_selector"])
+            if "stock_selector" in sel:
+                el_stock = sel["stock_selector"].select_one(el)
                 stock_text = el_stock.get_text(strip=True) if el_stock else None
         except Exception:
             LOG.exception("parse error for element")
@@ -109,87 +527,327 @@ def parse_with_bs4(html: str, cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
     return items
 
 
-def parse_with_playwright(url: str, cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+# 商品リストの抽出に不要なリソースはダウンロードしない
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet"})
+
+
+def _block_heavy_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+
+def _simple_item_selector(sel: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """item_selector が単一の tag / .class / tag.class なら (tag, class) を返す。"""
+    m = _SIMPLE_COMPOUND_RE.match(sel.strip())
+    if not m or m.group("id") or not (m.group("tag") or m.group("cls")):
+        return None
+    return (m.group("tag") or "").lower() or None, m.group("cls")
+
+
+class _NestedItemsError(Exception):
+    """商品要素が入れ子になっていてストリーミング解析できない。"""
+
+
+def _lxml_text(el) -> str:
+    # BeautifulSoup の get_text(strip=True) と同じく script / style の中身は含めない
+    texts = el.xpath("descendant-or-self::text()[not(ancestor::script or ancestor::style)]")
+    return "".join(t.strip() for t in texts)
+
+
+def _compile_field_xpaths(selectors: Dict[str, Any]) -> Dict[str, Any]:
+    """item_selector 以外のセレクタを XPath にコンパイルする。
+    cssselect が扱えないセレクタ (soupsieve 独自の擬似クラスなど) では SelectorError を送出する。"""
+    translator = HTMLTranslator()
+    return {k: etree.XPath(translator.css_to_xpath(v, prefix="descendant::"))
+            for k, v in selectors.items() if v and k != "item_selector"}
+
+
+def parse_with_lxml_stream(html: str, cfg: Dict[str, Any], xp: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """iterparse で商品要素が閉じるたびに抽出し、処理済みの部分木は捨てる。
+    メモリ使用量が文書全体ではなく商品 1 件分に抑えられる。item_selector は単純なものに限る。
+    xp は _compile_field_xpaths() の結果。商品要素が入れ子なら _NestedItemsError を送出する。"""
+    tag, cls = _simple_item_selector(cfg["selectors"]["item_selector"])
+
+    def matches(el) -> bool:
+        if not isinstance(el.tag, str) or (tag and el.tag != tag):
+            return False
+        return not cls or cls in (el.get("class") or "").split()
+
+    def first(key, el):
+        if key not in xp:
+            return None
+        found = xp[key](el)
+        return found[0] if found else None
+
+    items = []
+    for _, el in etree.iterparse(BytesIO(html.encode("utf-8")), events=("end",), tag=tag, html=True, encoding="utf-8"):
+        if not matches(el):
+            continue
+        # 入れ子だと内側が先に閉じてページ順が崩れ、外側の要素も読む前に消してしまう
+        if any(matches(a) for a in el.iterancestors()):
+            raise _NestedItemsError(cfg["selectors"]["item_selector"])
+        name = None
+        url = None
+        image = None
+        stock_text = None
+        try:
+            el_name = first("name_selector", el)
+            name = _lxml_text(el_name) if el_name is not None else None
+            el_url = first("url_selector", el)
+            if el_url is not None:
+                url = el_url.get("href") or el_url.get("data-href") or el_url.get("data-url")
+            el_img = first("image_selector", el)
+            if el_img is not None:
+                image = el_img.get("src") or el_img.get("data-src")
+            el_stock = first("stock_selector", el)
+            stock_text = _lxml_text(el_stock) if el_stock is not None else None
+        except Exception:
+            LOG.exception("parse error for element")
+        # 処理済みの要素とそれより前の兄弟を解放する
+        el.clear(keep_tail=True)
+        parent = el.getparent()
+        while parent is not None and el.getprevious() is not None:
+            del parent[0]
+        if not name and not url:
+            continue
+        items.append({
+            "id": url or name,
+            "name": name or "unknown",
+            "url": url,
+            "image": image,
+            "stock_text": stock_text
+        })
+    return items
+
+
+def parse_html(html: str, cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # ストリーミング解析では商品要素の部分木しか見えないため、
+    # フィールドのセレクタに結合子がある (祖先を参照し得る) 場合は bs4 で解析する
+    if (HAVE_LXML_STREAM and _simple_item_selector(cfg["selectors"]["item_selector"])
+            and _field_selectors_simple(cfg["selectors"])):
+        try:
+            xp = _compile_field_xpaths(cfg["selectors"])
+        except (SelectorError, etree.XPathError) as e:
+            LOG.debug("selectors not supported by cssselect, using bs4: %s", e)
+        else:
+            try:
+                return parse_with_lxml_stream(html, cfg, xp)
+            except _NestedItemsError:
+                LOG.debug("nested item elements, using bs4")
+    return parse_with_bs4(html, cfg)
+
+
+_EXTRACT_ITEMS_JS = """(els, s) => els.map(el => {
+    try {
+        const q = sel => sel ? el.querySelector(sel) : null;
+        const n = q(s.name_selector), u = q(s.url_selector), im = q(s.image_selector), st = q(s.stock_selector);
+        return {
+            name: n ? n.innerText.trim() : null,
+            url: u ? (u.getAttribute("href") || u.getAttribute("data-href") || u.getAttribute("data-url")) : null,
+            image: im ? (im.getAttribute("src") || im.getAttribute("data-src")) : null,
+            stock_text: st ? st.innerText.trim() : null,
+        };
+    } catch (e) {
+        return {error: String(e)};
+    }
+})"""
+
+
+def _scrape_page(page, url: str, cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    results = []
+    page.route("**/*", _block_heavy_resources)
+    LOG.info("Navigating to %s", url)
+    page.goto(url, wait_until="domcontentloaded", timeout=60000)
+    # networkidle は待たず、商品要素 (または wait_for_selector) が現れるまでだけ待つ
+    extra_wait = cfg.get("wait_for_selector") or cfg["selectors"]["item_selector"]
+    wait_timed_out = False
+    try:
+        page.wait_for_selector(extra_wait, timeout=15000)
+    except Exception:
+        wait_timed_out = True
+        LOG.warning("wait_for_selector timeout or not found: %s", extra_wait)
+    # 全商品のフィールドをブラウザ内で一括抽出する (要素ごとの IPC を発生させない)
+    raw = page.eval_on_selector_all(cfg["selectors"]["item_selector"], _EXTRACT_ITEMS_JS, cfg["selectors"])
+    LOG.info("Found %d elements with selector %s", len(raw), cfg["selectors"]["item_selector"])
+    if wait_timed_out and not raw:
+        # 読み込み途中の空リストで差分を取ると、次回に全商品が「新着」扱いになってしまう
+        raise RuntimeError(f"no items rendered before timeout on {url}")
+    for r in raw:
+        if r.get("error"):
+            LOG.error("error parsing element with playwright: %s", r["error"])
+            continue
+        name = r.get("name")
+        url_v = r.get("url")
+        if not name and not url_v:
+            continue
+        results.append({
+            "id": url_v or name,
+            "name": name or "unknown",
+            "url": url_v,
+            "image": r.get("image"),
+            "stock_text": r.get("stock_text")
+        })
+    return results
+
+
+def parse_with_playwright(url: str, cfg: Dict[str, Any], context=None) -> List[Dict[str, Any]]:
+    """context (BrowserContext) を渡すとその中でページを開いて閉じるだけにし、ブラウザを使い回す。"""
+    if context is not None:
+        page = context.new_page()
+        try:
+            return _scrape_page(page, url, cfg)
+        finally:
+            page.close()
     if not HAVE_PLAYWRIGHT:
         raise RuntimeError("Playwright is not available. Install with 'pip install playwright' and run 'playwright install'.")
-    results = []
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
-        page = browser.new_page(user_agent="Mozilla/5.0 (compatible; PopmartMonitor/1.0; +https://github.com/)")
-        LOG.info("Navigating to %s", url)
-        page.goto(url, wait_until="networkidle", timeout=60000)
-        extra_wait = cfg.get("wait_for_selector")
-        if extra_wait:
-            try:
-                page.wait_for_selector(extra_wait, timeout=15000)
-            except Exception:
-                LOG.debug("wait_for_selector timeout or not found: %s", extra_wait)
-        els = page.query_selector_all(cfg["selectors"]["item_selector"])
-        LOG.info("Found %d elements with selector %s", len(els), cfg["selectors"]["item_selector"])
-        for el in els:
-            try:
-                s = cfg["selectors"]
-                name = None
-                url_v = None
-                image = None
-                stock_text = None
-                if s.get("name_selector"):
-                    n = el.query_selector(s["name_selector"])
-                    name = n.inner_text().strip() if n else None
-                if s.get("url_selector"):
-                    u = el.query_selector(s["url_selector"])
-                    if u:
-                        url_v = u.get_attribute("href") or u.get_attribute("data-href") or u.get_attribute("data-url")
-                if s.get("image_selector"):
-                    im = el.query_selector(s["image_selector"])
-                    if im:
-                        image = im.get_attribute("src") or im.get_attribute("data-src")
-                if s.get("stock_selector"):
-                    st = el.query_selector(s["stock_selector"])
-                    stock_text = st.inner_text().strip() if st else None
-                if not name and not url_v:
-                    continue
-                results.append({
-                    "id": url_v or name,
-                    "name": name or "unknown",
-                    "url": url_v,
-                    "image": image,
-                    "stock_text": stock_text
-                })
-            except Exception:
-                LOG.exception("error parsing element with playwright")
-        browser.close()
-    return results
+        try:
+            page = browser.new_page(user_agent=USER_AGENT)
+            return _scrape_page(page, url, cfg)
+        finally:
+            browser.close()
+
 
+DEFAULT_SOLD_OUT_PATTERNS = ("sold out", "売り切れ", "欠品")
+DEFAULT_IN_STOCK_PATTERNS = ("add to cart", "カートに入れる", "在庫あり", "在庫")
 
-def is_in_stock(item: Dict[str, Any], cfg: Dict[str, Any]) -> bool:
-    text = (item.get("stock_text") or "").lower()
-    sold_out_patterns = [p.lower() for p in cfg.get("sold_out_patterns", ["sold out", "売り切れ", "欠品"])]
-    in_stock_patterns = [p.lower() for p in cfg.get("in_stock_patterns", ["add to cart", "カートに入れる", "在庫あり", "在庫"])]
 
+# これ以上のアイテム数では stock_text を連結して 1 回のオートマトン走査で判定する
+BULK_SCAN_MIN_ITEMS = 64
+_TEXT_SEPARATOR = "\x00"
+
+
+def _pattern_key(cfg: Dict[str, Any]) -> Tuple[tuple, tuple]:
+    return (
+        tuple(cfg.get("sold_out_patterns", DEFAULT_SOLD_OUT_PATTERNS)),
+        tuple(cfg.get("in_stock_patterns", DEFAULT_IN_STOCK_PATTERNS)),
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _build_automaton(sold_out_patterns: tuple, in_stock_patterns: tuple):
+    """在庫あり True / 売り切れ False を値に持つ Automaton を返す (パターンが空なら None)。"""
+    aut = ahocorasick.Automaton()
+    # 両方に含まれるパターンは後から登録する在庫あり側で上書きする
+    for p in sold_out_patterns:
+        if p:
+            aut.add_word(p.lower(), False)
     for p in in_stock_patterns:
-        if p in text:
+        if p:
+            aut.add_word(p.lower(), True)
+    if len(aut) == 0:
+        return None
+    aut.make_automaton()
+    return aut
+
+
+@functools.lru_cache(maxsize=4)
+def _build_stock_matcher(sold_out_patterns: tuple, in_stock_patterns: tuple) -> Callable[[str], Optional[bool]]:
+    """小文字化済みテキストを受け取り、在庫あり True / 売り切れ False / 該当なし None を返す関数を作る。
+    在庫ありのパターンが売り切れより優先される。"""
+    if HAVE_AHOCORASICK:
+        aut = _build_automaton(sold_out_patterns, in_stock_patterns)
+        if aut is None:
+            return lambda text: None
+
+        def match(text: str) -> Optional[bool]:
+            result = None
+            for _, value in aut.iter(text):
+                if value:
+                    return True
+                result = False
+            return result
+        return match
+
+    sold = [p.lower() for p in sold_out_patterns if p]
+    in_ = [p.lower() for p in in_stock_patterns if p]
+    in_re = re.compile("|".join(map(re.escape, in_))) if in_ else None
+    sold_re = re.compile("|".join(map(re.escape, sold))) if sold else None
+
+    def match(text: str) -> Optional[bool]:
+        if in_re and in_re.search(text):
             return True
-    for p in sold_out_patterns:
-        if p in text:
+        if sold_re and sold_re.search(text):
             return False
+        return None
+    return match
+
+
+def _resolve_stock(matched: Optional[bool], text: str, assume_in_stock: bool) -> bool:
+    if matched is not None:
+        return matched
     if text.strip() == "":
-        return cfg.get("assume_in_stock_if_no_label", False)
+        return assume_in_stock
     return False
 
 
-def build_discord_embed(item: Dict[str, Any], cfg: Dict[str, Any], reason: str) -> dict:
+def compile_stock_checker(cfg: Dict[str, Any]) -> Callable[[Optional[str]], bool]:
+    """設定から在庫判定関数を一度だけ組み立てる。返り値は stock_text を受け取り在庫有無を返す。"""
+    matcher = _build_stock_matcher(*_pattern_key(cfg))
+    assume_in_stock = cfg.get("assume_in_stock_if_no_label", False)
+
+    def check(stock_text: Optional[str]) -> bool:
+        text = (stock_text or "").lower()
+        return _resolve_stock(matcher(text), text, assume_in_stock)
+    return check
+
+
+def is_in_stock(item: Dict[str, Any], checker: Callable[[Optional[str]], bool]) -> bool:
+    return checker(item.get("stock_text"))
+
+
+def stock_flags(items: List[Dict[str, Any]], cfg: Dict[str, Any]) -> List[bool]:
+    """items の在庫有無をまとめて判定する。
+    アイテム数が多いときは stock_text を区切り文字で連結し、オートマトンを 1 回だけ走らせる。"""
+    if not HAVE_AHOCORASICK or len(items) < BULK_SCAN_MIN_ITEMS:
+        checker = compile_stock_checker(cfg)
+        return [is_in_stock(it, checker) for it in items]
+
+    texts = [(it.get("stock_text") or "").lower() for it in items]
+    assume_in_stock = cfg.get("assume_in_stock_if_no_label", False)
+    aut = _build_automaton(*_pattern_key(cfg))
+    matched: List[Optional[bool]] = [None] * len(texts)
+    if aut is not None:
+        starts = []
+        pos = 0
+        for t in texts:
+            starts.append(pos)
+            pos += len(t) + len(_TEXT_SEPARATOR)
+        for end, value in aut.iter(_TEXT_SEPARATOR.join(texts)):
+            k = bisect.bisect_right(starts, end) - 1
+            if value:
+                matched[k] = True
+            elif matched[k] is None:
+                matched[k] = False
+    return [_resolve_stock(m, t, assume_in_stock) for m, t in zip(matched, texts)]
+
+
+def _utc_iso(now: datetime) -> str:
+    return now.isoformat().replace("+00:00", "Z")
+
+
+def build_discord_embed(item: Dict[str, Any], cfg: Dict[str, Any], reason: str,
+                        now_iso: Optional[str] = None, now_human: Optional[str] = None,
+                        page_url: Optional[str] = None) -> dict:
+    if now_iso is None or now_human is None:
+        now = datetime.now(timezone.utc)
+        now_iso = _utc_iso(now)
+        now_human = now.strftime("%Y-%m-%d %H:%M:%S UTC")
     title = item.get("name") or "New item"
-    url = item.get("url") or cfg.get("url")
+    # 商品リンクがなければ、その商品が載っていた監視ページにリンクする
+    url = item.get("url") or page_url or cfg.get("url")
     image = item.get("image")
     desc = f"{reason}"
     embed = {
         "title": title,
         "url": url,
         "description": desc,
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": now_iso,
         "fields": [
-            {"name": "検出日時", "value": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"), "inline": True},
+            {"name": "検出日時", "value": now_human, "inline": True},
             {"name": "状態", "value": reason, "inline": True},
         ]
     }
@@ -198,76 +856,205 @@ def build_discord_embed(item: Dict[str, Any], cfg: Dict[str, Any], reason: str)
     return embed
 
 
-def main():
-    cfg = load_config("config.json")
-    state_path = cfg.get("state_file", "state.json")
-    state = load_state(state_path)
-    prev_items: Dict[str, Any] = state.get("items", {})
+def _poll_one(url: str, cfg: Dict[str, Any], http_cache: Dict[str, Any], context=None) -> Optional[List[Dict[str, Any]]]:
+    """1 つの URL を取得・解析して items を返す。ページが前回から変わっていなければ None。"""
+    if cfg.get("use_requests", False):
+        entry = http_cache.get(url) or {}
+        cfg_hash = config_digest(cfg)
+        same_cfg = entry.get("cfg_digest") == cfg_hash
+        # 設定が変わっていたら 304 を受け取っても意味がないので条件付き GET にしない
+        html, validators = fetch_with_requests(url, validators=entry if same_cfg else None)
+        if html is None:
+            LOG.info("Page not modified since last check: %s", url)
+            return None
+        html_hash = html_digest(html)
+        if same_cfg and html_hash == entry.get("html_hash"):
+            # 内容が前回と同一: 解析も通知もしないが、新しい ETag 等は覚えておく
+            http_cache[url] = {**validators, "html_hash": html_hash, "cfg_digest": cfg_hash}
+            LOG.info("Page not modified since last check: %s", url)
+            return None
+        items = parse_html(html, cfg)
+        http_cache[url] = {**validators, "html_hash": html_hash, "cfg_digest": cfg_hash}
+    else:
+        items = parse_with_playwright(url, cfg, context=context)
+    LOG.info("Parsed %d items from %s", len(items), url)
+    return items
 
-    try:
-        if cfg.get("use_requests", False):
-            LOG.info("Using requests + bs4 fetch")
-            html = fetch_with_requests(cfg["url"])
-            items = parse_with_bs4(html, cfg)
-        else:
-            LOG.info("Using Playwright fetch")
-            items = parse_with_playwright(cfg["url"], cfg)
-    except Exception as e:
-        LOG.exception("Failed to fetch or parse the page: %s", e)
-        return
 
-    LOG.info("Parsed %d items", len(items))
+def _diff_items(items: List[Dict[str, Any]], prev_items: Dict[str, Any], cfg: Dict[str, Any],
+                now: datetime, page_url: str) -> Tuple[Dict[str, Any], List[tuple]]:
+    # 比較はアイテム dict ではなく並列リスト (ids / in_stocks) と前回状態の集合で行い、
+    # dict 形式は通知対象と保存用にだけ作る
+    ids = [it.get("id") or it.get("name") for it in items]
+    in_stocks = stock_flags(items, cfg)
+    prev_out = frozenset(i for i, v in prev_items.items() if v.get("in_stock") is False)
+    prev_seen = prev_items.keys()
 
-    webhook = cfg.get("discord_webhook_url") or os.environ.get("DISCORD_WEBHOOK_URL")
-    if not webhook:
-        LOG.error("Discord webhook URL not configured. Set discord_webhook_url in config.json or DISCORD_WEBHOOK_URL env var.")
-        return
+    reasons: Dict[int, str] = {}
+    for k, (item_id, c) in enumerate(zip(ids, in_stocks)):
+        if c and item_id in prev_out:
+            reasons[k] = "売り切れ → 入荷 (restock)"
+    notify_new_in_stock = cfg.get("notify_new_in_stock", True)
+    notify_new = cfg.get("notify_new", False)
+    for k, (item_id, c) in enumerate(zip(ids, in_stocks)):
+        if item_id in prev_seen:
+            continue
+        if c and notify_new_in_stock:
+            reasons[k] = "新着入荷 (new & in stock)"
+        elif notify_new:
+            reasons[k] = "新着 (new item)"
 
-    new_state_items = {}
-    notifications = []
-    for it in items:
-        item_id = it.get("id") or it.get("name")
-        in_stock = is_in_stock(it, cfg)
-        prev = prev_items.get(item_id)
-        prev_in_stock = prev.get("in_stock") if prev else None
-        reason = None
-        if prev:
-            if prev_in_stock is False and in_stock:
-                reason = "売り切れ → 入荷 (restock)"
-        else:
-            if in_stock and cfg.get("notify_new_in_stock", True):
-                reason = "新着入荷 (new & in stock)"
-            elif cfg.get("notify_new", False):
-                reason = "新着 (new item)"
+    now_iso = _utc_iso(now)
+    now_human = now.strftime("%Y-%m-%d %H:%M:%S UTC")
+    notifications = [(items[k], build_discord_embed(items[k], cfg, reasons[k], now_iso, now_human, page_url))
+                     for k in sorted(reasons)]
 
-        new_state_items[item_id] = {
+    new_state_items = {
+        item_id: {
             "name": it.get("name"),
             "url": it.get("url"),
             "image": it.get("image"),
             "stock_text": it.get("stock_text"),
             "in_stock": in_stock,
-            "last_seen": datetime.utcnow().isoformat() + "Z"
+            "last_changed": now_iso
         }
+        for item_id, it, in_stock in zip(ids, items, in_stocks)
+    }
+    return new_state_items, notifications
 
-        if reason:
-            embed = build_discord_embed(it, cfg, reason)
-            notifications.append((it, embed))
 
-    state["items"] = new_state_items
-    state["last_checked"] = datetime.utcnow().isoformat() + "Z"
-    save_state(state, state_path)
-    LOG.info("State saved to %s", state_path)
+def _items_by_url(state: Dict[str, Any], urls: List[str]) -> Dict[str, Any]:
+    items = state.get("items", {})
+    # 旧形式 ({item_id: item}) の state は最初の URL のものとして読み替える
+    if any(isinstance(v, dict) and "in_stock" in v for v in items.values()):
+        return {urls[0]: items}
+    return items
 
-    for it, embed in notifications:
-        try:
-            content = cfg.get("mention_role")
-            send_discord_webhook(webhook, content=content, embeds=[embed])
-            LOG.info("Sent notification for %s", it.get("name"))
-            time.sleep(1)
-        except Exception:
-            LOG.exception("Failed to send notification for %s", it.get("name"))
 
-    LOG.info("Done. Notifications sent: %d", len(notifications))
+def poll(cfg: Dict[str, Any], context=None):
+    urls = cfg.get("urls") or [cfg["url"]]
+    db_path = cfg.get("state_db", "state.sqlite")
+    with closing(open_state_db(db_path)) as conn:
+        migrate_json_state(conn, cfg.get("state_file", "state.json"), urls[0])
+        _poll_with_db(conn, cfg, urls, context=context)
+
+
+def _poll_with_db(conn: sqlite3.Connection, cfg: Dict[str, Any], urls: List[str], context=None):
+    items_by_url = load_items(conn)
+    http_cache = load_http_cache(conn)
+
+    LOG.info("Using %s fetch for %d url(s)", "requests + bs4" if cfg.get("use_requests", False) else "Playwright", len(urls))
+    results: Dict[str, Optional[List[Dict[str, Any]]]] = {}
+    if cfg.get("use_requests", False) and len(urls) > 1:
+        # requests 経由の取得は URL ごとに独立した I/O なので並列に行う
+        with ThreadPoolExecutor(max_workers=min(8, len(urls))) as ex:
+            futures = {url: ex.submit(_poll_one, url, cfg, http_cache) for url in urls}
+        for url, fut in futures.items():
+            try:
+                results[url] = fut.result()
+            except Exception as e:
+                LOG.exception("Failed to fetch or parse the page %s: %s", url, e)
+    else:
+        # Playwright の sync API はスレッドをまたげないので順番に処理する
+        for url in urls:
+            try:
+                results[url] = _poll_one(url, cfg, http_cache, context=context)
+            except Exception as e:
+                LOG.exception("Failed to fetch or parse the page %s: %s", url, e)
+
+    if not results:
+        return
+    # 時刻は 1 回の監視につき一度だけ取得し、全アイテムで共有する
+    now = datetime.now(timezone.utc)
+    changed = {url: items for url, items in results.items() if items is not None}
+    if not changed:
+        with conn:
+            save_http_cache(conn, {url: http_cache[url] for url in results if url in http_cache})
+            set_meta(conn, "last_checked", _utc_iso(now))
+        return
+
+    webhook = cfg.get("discord_webhook_url") or os.environ.get("DISCORD_WEBHOOK_URL")
+    if not webhook:
+        LOG.error("Discord webhook URL not configured. Set discord_webhook_url in config.json or DISCORD_WEBHOOK_URL env var.")
+        return
+
+    notifications = []
+    written = 0
+    with conn:
+        for url in urls:
+            if url not in changed:
+                continue
+            prev_items = items_by_url.get(url, {})
+            new_state_items, url_notifications = _diff_items(changed[url], prev_items, cfg, now, url)
+            written += save_items(conn, url, prev_items, new_state_items)
+            notifications.extend(url_notifications)
+        # 設定から外れた URL のアイテムは削除する
+        conn.execute(f"DELETE FROM items WHERE page_url NOT IN ({', '.join('?' * len(urls))})", urls)
+        save_http_cache(conn, {url: http_cache[url] for url in results if url in http_cache})
+        set_meta(conn, "last_checked", _utc_iso(now))
+    LOG.info("State saved (%d rows changed)", written)
+
+    sent = send_notifications(webhook, notifications, content=cfg.get("mention_role"))
+
+    LOG.info("Done. Notifications sent: %d/%d", sent, len(notifications))
+
+
+def _launch_browser(playwright):
+    browser = playwright.chromium.launch(headless=True)
+    return browser, browser.new_context(user_agent=USER_AGENT)
+
+
+def _close_browser(browser):
+    if browser is None:
+        return
+    try:
+        browser.close()
+    except Exception:
+        LOG.debug("error while closing browser", exc_info=True)
+
+
+def _context_usable(context) -> bool:
+    try:
+        context.new_page().close()
+        return True
+    except Exception:
+        return False
+
+
+def run(cfg: Dict[str, Any], playwright=None):
+    """poll_interval (秒) が設定されていれば繰り返し監視し、なければ 1 回だけ実行する。
+    playwright を渡すとブラウザとコンテキストを 1 つだけ起動してループ全体で使い回し、
+    ページを開けなくなったら起動し直す。繰り返し監視中の例外はログに出して次回に持ち越す。"""
+    interval = cfg.get("poll_interval", 0)
+    browser = context = None
+    try:
+        while True:
+            try:
+                if playwright is not None and (context is None or not _context_usable(context)):
+                    if context is not None:
+                        LOG.warning("Browser context is no longer usable, relaunching")
+                    _close_browser(browser)
+                    browser = context = None
+                    browser, context = _launch_browser(playwright)
+                poll(cfg, context=context)
+            except Exception:
+                if not interval:
+                    raise
+                LOG.exception("Poll failed, retrying in %ss", interval)
+            if not interval:
+                return
+            time.sleep(interval)
+    finally:
+        _close_browser(browser)
+
+
+def main():
+    cfg = load_config("config.json")
+    if cfg.get("use_requests", False) or not HAVE_PLAYWRIGHT:
+        run(cfg)
+        return
+    with sync_playwright() as p:
+        run(cfg, playwright=p)
 
 
 if __name__ == "__main__":
@@ -7,8 +7,14 @@ selector_inspector.py
 """
 import os
 import json
+import hashlib
+from pathlib import Path
 from playwright.sync_api import sync_playwright
 
+# URL ごとに前回見つかったトップセレクタを覚えておくキャッシュ
+_SELECTOR_CACHE = Path("~/.popmart_sel_cache.json").expanduser()
+CACHE_MIN_ITEMS = 3
+
 def load_cfg(path="config.json"):
     if os.path.exists(path):
         with open(path, "r", encoding="utf-8") as f:
@@ -18,7 +24,37 @@ def load_cfg(path="config.json"):
 def short(s, n=400):
     return s if len(s) <= n else s[:n] + " ... [truncated]"
 
-def guess_item_selectors(page):
+def _url_key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+def load_selector_cache():
+    try:
+        with open(_SELECTOR_CACHE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_selector_cache(cache):
+    try:
+        tmp = str(_SELECTOR_CACHE) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, _SELECTOR_CACHE)
+    except OSError as e:
+        print("Failed to write selector cache:", e)
+
+def probe_cached_selector(page, url, cache):
+    """キャッシュ済みセレクタがまだ十分な要素数を返すなら (selector, count) を返す。"""
+    sel = cache.get(_url_key(url))
+    if not sel:
+        return None
+    try:
+        n = len(page.query_selector_all(sel))
+    except Exception:
+        return None
+    return (sel, n) if n >= CACHE_MIN_ITEMS else None
+
+def guess_item_selectors(page, min_items=10):
     candidates = [
         "ul.product-list li",
         ".product-list .product-item",
@@ -30,26 +66,43 @@ def guess_item_selectors(page):
         ".product-list li",
         ".list-product .item"
     ]
-    found = []
-    for c in candidates:
-        try:
-            els = page.query_selector_all(c)
-            if els and len(els) >= 1:
-                found.append((c, len(els)))
-        except Exception:
-            pass
-    return found
+    # 候補の件数をブラウザ内で一括計算する (IPC は 1 回)。
+    # min_items 件以上ヒットした候補が見つかった時点で打ち切る。
+    js = """([cands, minItems]) => {
+        const out = [];
+        for (const c of cands) {
+            let n;
+            try { n = document.querySelectorAll(c).length; } catch (e) { n = -1; }
+            out.push(n);
+            if (n >= minItems) break;
+        }
+        return out;
+    }"""
+    try:
+        counts = page.evaluate(js, [candidates, min_items])
+    except Exception:
+        return []
+    return [(c, n) for c, n in zip(candidates, counts) if n >= 1]
 
-def inspect(url):
+def inspect(url, min_items=10):
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
         page = browser.new_page()
         page.goto(url, wait_until="networkidle", timeout=60000)
-        guesses = guess_item_selectors(page)
+        cache = load_selector_cache()
+        cached = probe_cached_selector(page, url, cache)
+        if cached:
+            print("CACHED_SELECTOR:", cached)
+            guesses = [cached]
+        else:
+            guesses = guess_item_selectors(page, min_items)
         print("GUESS_ITEM_SELECTORS:", guesses)
         if guesses:
             top = sorted(guesses, key=lambda x: -x[1])[0][0]
             print(f"TOP_SELECTOR: {top}")
+            if not cached:
+                cache[_url_key(url)] = top
+                save_selector_cache(cache)
             els = page.query_selector_all(top)[:6]
             for i, el in enumerate(els):
                 print(f"--- ITEM {i+1} ---")
@@ -79,4 +132,4 @@ if __name__ == '__main__':
         print("No URL provided. Set TARGET_URL env or config.json url.")
         exit(2)
     print("Inspecting URL:", url)
-    inspect(url)
+    inspect(url, cfg.get("guess_min_items", 10))
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("bs4")
+monitor = pytest.importorskip("monitor")
+
+HTML = """<html><body>
+<ul class="list grid">
+  <li class="p product-item"><a href="/a"><h3>A</h3></a><span class="badge">Add to cart</span></li>
+  <li class="p product-item is-soldout"><a href="/b"><h3>B</h3></a><span class="badge">SOLD OUT</span></li>
+</ul>
+<div><h3>outside</h3></div>
+</body></html>"""
+
+
+def _cfg(**selectors):
+    base = {
+        "item_selector": "li.p",
+        "name_selector": "h3",
+        "url_selector": "a",
+        "image_selector": "img",
+        "stock_selector": ".badge",
+    }
+    base.update(selectors)
+    return {"selectors": base}
+
+
+@pytest.mark.parametrize("selectors", [
+    {},
+    {"url_selector": "li > a"},
+    {"url_selector": ".p a", "name_selector": ".list h3"},
+    {"item_selector": ".product-item", "stock_selector": ".is-soldout .badge"},
+    {"item_selector": ".product-item", "name_selector": ".grid h3"},
+    {"name_selector": "h2, h3", "stock_selector": "span:-soup-contains('OUT')"},
+])
+def test_parse_html_matches_bs4(selectors):
+    cfg = _cfg(**selectors)
+    expected = monitor.parse_with_bs4(HTML, cfg)
+    assert expected
+    assert monitor.parse_html(HTML, cfg) == expected
+
+
+def test_bs4_reads_fields_through_item_ancestors():
+    items = monitor.parse_with_bs4(HTML, _cfg(item_selector=".product-item", name_selector=".grid h3"))
+    assert [it["name"] for it in items] == ["A", "B"]